@@ -1,14 +1,19 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from contextlib import asynccontextmanager
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, conlist, constr
+from typing import Optional, Tuple
 from dotenv import load_dotenv
-from services.database_service import DatabaseService
-from services.vector_service import VectorService
+from anyio import to_thread
+from cachetools import TTLCache
+from services.database_service import DatabaseService, get_database_service
+from services.vector_service import VectorService, get_vector_service
 from services.chain_service import ChainService
 import os
 import logging
+import orjson
 
 # Load environment variables
 load_dotenv()
@@ -22,26 +27,34 @@ database_service: Optional[DatabaseService] = None
 vector_service: Optional[VectorService] = None
 chain_service: Optional[ChainService] = None
 
+# conversation_id -> owning session_id, so follow-up turns skip the ownership query
+conversation_owner_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize and cleanup services"""
     global database_service, vector_service, chain_service
     
+    # Only short SQLite calls use the threadpool now (Gemini is awaited directly),
+    # so anyio's default of 40 threads is plenty; tunable for unusual loads
+    to_thread.current_default_thread_limiter().total_tokens = int(os.getenv("THREADPOOL_SIZE", "40"))
+    
     # Initialize services
     try:
         logger.info("Initializing services...")
         
         # Initialize Database Service
-        database_service = DatabaseService()
+        database_service = get_database_service()
         logger.info("Database service initialized")
         
         # Initialize Vector Service
-        vector_service = VectorService()
+        vector_service = get_vector_service()
         logger.info("Vector service initialized")
         
         # Initialize Chain Service
         chain_service = ChainService(database_service, vector_service)
-        if not chain_service.validate_api_key("gemini-1.5-flash"):
+        # Validation doubles as warm-up: it opens the Gemini connection early
+        if not await chain_service.validate_api_key("gemini-1.5-flash"):
             raise ValueError("Invalid Gemini API key")
         logger.info("Chain service initialized")
         
@@ -55,23 +68,40 @@ async def lifespan(app: FastAPI):
     
     # Cleanup (if needed)
     logger.info("Shutting down services...")
+    if chain_service:
+        chain_service.shutdown()
+    if database_service:
+        database_service.close()
+        get_database_service.cache_clear()
 
 # Create FastAPI app with lifespan
-app = FastAPI(title="TutorBot API", version="2.0.0", lifespan=lifespan)
+app = FastAPI(
+    title="TutorBot API",
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Configure CORS
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+ALLOWED_ORIGINS = list(dict.fromkeys([
+    "http://localhost:3000",  # Local development
+    "https://daksh204singh.github.io",  # GitHub Pages
+    FRONTEND_URL  # Environment variable
+]))
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:3000",  # Local development
-        "https://daksh204singh.github.io",  # GitHub Pages
-        os.getenv("FRONTEND_URL", "http://localhost:3000")  # Environment variable
-    ],
+    allow_origins=ALLOWED_ORIGINS,
     # Allow all GitHub Pages origins like https://username.github.io
     allow_origin_regex=r"^https:\/\/([A-Za-z0-9-]+)\.github\.io$",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the frontend read the IDs that /chat/stream sends as headers
+    expose_headers=["X-Session-Id", "X-Conversation-Id"],
+    # Let browsers reuse preflight results instead of re-sending OPTIONS
+    max_age=86400,
 )
 
 # Pydantic models
@@ -85,11 +115,16 @@ class Persona(BaseModel):
     persona: str
     model: str = "gemini-2.0-flash-exp"
 
+# Client-supplied IDs are echoed back in response headers, so they are limited
+# to header-safe tokens (UUIDs and the like) and rejected before anything is created;
+# an empty ID still means "start a new one", as before
+HeaderSafeId = constr(pattern=r"^[A-Za-z0-9_-]{0,64}$")
+
 class ChatRequest(BaseModel):
-    messages: List[Message]
+    messages: conlist(Message, min_length=1)  # only the latest message is used
     persona: Persona
-    session_id: Optional[str] = None
-    conversation_id: Optional[str] = None
+    session_id: Optional[HeaderSafeId] = None
+    conversation_id: Optional[HeaderSafeId] = None
 
 class ChatResponse(BaseModel):
     response: str
@@ -99,20 +134,29 @@ class ChatResponse(BaseModel):
     session_id: str
     context_used: Optional[bool] = None
 
-class ConversationResponse(BaseModel):
-    id: str
-    bot_name: str
-    persona: str
-    model: str
-    created_at: str
-    updated_at: str
-
 class SessionResponse(BaseModel):
     session_id: str
 
+# Static payloads, serialized once instead of on every request
+ROOT_BODY = orjson.dumps({"message": "TutorBot API v2.0 is running"})
+MODELS_BODY = orjson.dumps({
+    "models": [
+        {
+            "id": "gemini-2.0-flash-exp",
+            "name": "Gemini 2.0 Flash",
+            "description": "Latest fast and efficient model for general tasks"
+        },
+        {
+            "id": "gemini-1.5-flash",
+            "name": "Gemini 1.5 Flash",
+            "description": "Previous generation fast model"
+        }
+    ]
+})
+
 @app.get("/")
 async def root():
-    return {"message": "TutorBot API v2.0 is running"}
+    return Response(ROOT_BODY, media_type="application/json")
 
 @app.get("/health")
 async def health_check():
@@ -126,39 +170,46 @@ async def health_check():
         }
     }
 
+async def resolve_conversation(request: ChatRequest) -> Tuple[str, str]:
+    """Return (session_id, conversation_id) for a chat request, creating the conversation if needed"""
+    # Handle session and conversation management
+    session_id = database_service.get_or_create_session_id(request.session_id)
+    
+    # If no conversation_id provided, create a new conversation
+    if not request.conversation_id:
+        conversation_id = await run_in_threadpool(
+            database_service.create_conversation,
+            session_id=session_id,
+            bot_name=request.persona.bot_name,
+            persona=request.persona.persona,
+            model=request.persona.model
+        )
+        conversation_owner_cache[conversation_id] = session_id
+    else:
+        conversation_id = request.conversation_id
+        # Verify conversation exists and belongs to session (cached after the first check)
+        if conversation_owner_cache.get(conversation_id) != session_id:
+            conversation = await run_in_threadpool(database_service.get_conversation, conversation_id)
+            if not conversation or conversation["session_id"] != session_id:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            conversation_owner_cache[conversation_id] = session_id
+    
+    return session_id, conversation_id
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Main chat endpoint - simplified to use ChainService"""
     try:
-        # Handle session and conversation management
-        session_id = database_service.get_or_create_session_id(request.session_id)
-        
-        # If no conversation_id provided, create a new conversation
-        if not request.conversation_id:
-            conversation_id = database_service.create_conversation(
-                session_id=session_id,
-                bot_name=request.persona.bot_name,
-                persona=request.persona.persona,
-                model=request.persona.model
-            )
-        else:
-            conversation_id = request.conversation_id
-            # Verify conversation exists and belongs to session
-            conversation = database_service.get_conversation(conversation_id)
-            if not conversation or conversation["session_id"] != session_id:
-                raise HTTPException(status_code=404, detail="Conversation not found")
+        session_id, conversation_id = await resolve_conversation(request)
         
         # Get the latest user message
-        if not request.messages:
-            raise HTTPException(status_code=400, detail="No messages provided")
-        
         latest_message = request.messages[-1].content
         
-        # Invoke the chain service
-        result = chain_service.invoke_chain(
+        # Invoke the chain service; it awaits Gemini without tying up a thread
+        result = await chain_service.invoke_chain(
             conversation_id=conversation_id,
             query=latest_message,
-            persona=request.persona.dict(),
+            persona=request.persona.model_dump(),
             model_name=request.persona.model
         )
         
@@ -180,23 +231,39 @@ async def chat(request: ChatRequest):
         logger.error(f"Error in chat endpoint: {e}")
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Chat endpoint that streams the response as it is generated"""
+    try:
+        session_id, conversation_id = await resolve_conversation(request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in chat stream endpoint: {e}")
+        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    
+    # IDs travel in headers because the body is the response text itself;
+    # the cache/buffering headers stop proxies from holding chunks back
+    return StreamingResponse(
+        chain_service.stream_chain(
+            conversation_id=conversation_id,
+            query=request.messages[-1].content,
+            persona=request.persona.model_dump(),
+            model_name=request.persona.model
+        ),
+        media_type="text/plain; charset=utf-8",
+        headers={
+            "X-Session-Id": session_id,
+            "X-Conversation-Id": conversation_id,
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
 @app.get("/models")
 async def get_models():
     """Get available models"""
-    return {
-        "models": [
-            {
-                "id": "gemini-2.0-flash-exp",
-                "name": "Gemini 2.0 Flash",
-                "description": "Latest fast and efficient model for general tasks"
-            },
-            {
-                "id": "gemini-1.5-flash",
-                "name": "Gemini 1.5 Flash",
-                "description": "Previous generation fast model"
-            }
-        ]
-    }
+    return Response(MODELS_BODY, media_type="application/json")
 
 @app.post("/session", response_model=SessionResponse)
 async def create_session():
@@ -208,22 +275,12 @@ async def create_session():
         logger.error(f"Error creating session: {e}")
         raise HTTPException(status_code=500, detail=f"Error creating session: {str(e)}")
 
-@app.get("/session/{session_id}/conversations", response_model=List[ConversationResponse])
+@app.get("/session/{session_id}/conversations")
 async def get_session_conversations(session_id: str):
     """Get all conversations for a session"""
     try:
-        conversations = database_service.get_session_conversations(session_id)
-        return [
-            ConversationResponse(
-                id=conv["id"],
-                bot_name=conv["bot_name"],
-                persona=conv["persona"],
-                model=conv["model"],
-                created_at=conv["created_at"],
-                updated_at=conv["updated_at"]
-            )
-            for conv in conversations
-        ]
+        # Rows already have the response shape; let orjson dump them as-is
+        return database_service.get_session_conversations(session_id)
     except Exception as e:
         logger.error(f"Error getting session conversations: {e}")
         raise HTTPException(status_code=500, detail=f"Error getting conversations: {str(e)}")
@@ -251,8 +308,11 @@ async def get_conversation(conversation_id: str):
 async def delete_conversation(conversation_id: str):
     """Delete a conversation and all its messages"""
     try:
+        # Stop vouching for the conversation before it disappears
+        conversation_owner_cache.pop(conversation_id, None)
+        
         # Delete from database
-        success = database_service.delete_conversation(conversation_id)
+        success = await run_in_threadpool(database_service.delete_conversation, conversation_id)
         if not success:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
@@ -271,7 +331,7 @@ async def get_stats():
     """Get system statistics"""
     try:
         db_stats = {
-            "total_conversations": len(database_service.get_all_conversations())
+            "total_conversations": await run_in_threadpool(database_service.count_conversations)
         }
         
         vector_stats = vector_service.get_all_stats()
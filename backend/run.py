@@ -5,6 +5,7 @@ Startup script for TutorBot FastAPI backend
 
 import uvicorn
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,7 +16,25 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
     
-    print(f"Starting TutorBot API server on {host}:{port}")
+    # Auto-reload is for development only: it puts a file watcher in front of
+    # a single server process and cannot be combined with multiple workers
+    reload = os.getenv("RELOAD", "false").lower() == "true"
+    
+    # Conversation memory and FAISS indexes are held in-process, so more than
+    # one worker is only safe behind a proxy that pins a session to a worker
+    workers = 1 if reload else int(os.getenv("WORKERS", "1"))
+    
+    # Serve HTTPS directly when a certificate is configured; plain HTTP
+    # remains the default for local development
+    ssl_certfile = os.getenv("SSL_CERTFILE")
+    ssl_keyfile = os.getenv("SSL_KEYFILE")
+    scheme = "https" if ssl_certfile and ssl_keyfile else "http"
+    
+    # uvloop and the httptools parser (both from uvicorn[standard]) outpace the
+    # default asyncio loop and h11; uvloop is not available on Windows
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    
+    print(f"Starting TutorBot API server on {scheme}://{host}:{port} ({workers} worker(s))")
     print("Press Ctrl+C to stop the server")
     
     # Run the server
@@ -23,6 +42,11 @@ if __name__ == "__main__":
         "main:app",
         host=host,
         port=port,
-        reload=True,  # Enable auto-reload for development
+        reload=reload,
+        workers=workers,
+        loop=loop,
+        http="httptools",
+        ssl_certfile=ssl_certfile if scheme == "https" else None,
+        ssl_keyfile=ssl_keyfile if scheme == "https" else None,
         log_level="info"
     )
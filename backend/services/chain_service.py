@@ -1,14 +1,20 @@
 import os
+import re
+import hashlib
+import asyncio
 import logging
-from typing import Dict, List, Optional
-from datetime import datetime
-import threading
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+
+import numpy as np
+import tiktoken
+from cachetools import LRUCache, TTLCache
 
-from langchain.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.schema import BaseMessage, HumanMessage, AIMessage
-from langchain.schema.memory import BaseMemory
-from langchain.chains import ConversationChain
+from langchain.schema import BaseMessage, HumanMessage, SystemMessage
 from langchain.memory import ConversationSummaryBufferMemory
 
 from .database_service import DatabaseService
@@ -16,96 +22,60 @@ from .vector_service import VectorService
 
 logger = logging.getLogger(__name__)
 
-class DatabaseBackedMemory(BaseMemory):
-    """Custom memory class that uses DatabaseService for persistence"""
-    
-    def __init__(self, database_service: DatabaseService, conversation_id: str, max_token_limit: int = 2000):
-        super().__init__()
-        self._database_service = database_service
-        self._conversation_id = conversation_id
-        self._max_token_limit = max_token_limit
-        self._messages: List[BaseMessage] = []
-        self._load_messages()
-    
-    @property
-    def messages(self) -> List[BaseMessage]:
-        return self._messages
-    
-    @property
-    def database_service(self) -> DatabaseService:
-        return self._database_service
-    
-    @property
-    def conversation_id(self) -> str:
-        return self._conversation_id
-    
-    def _load_messages(self):
-        """Load messages from database"""
-        try:
-            db_messages = self._database_service.get_conversation_messages(self._conversation_id)
-            self.messages = []
-            
-            for msg in db_messages:
-                if msg['role'] == 'user':
-                    self.messages.append(HumanMessage(content=msg['content']))
-                elif msg['role'] == 'assistant':
-                    self.messages.append(AIMessage(content=msg['content']))
-            
-            logger.info(f"Loaded {len(self.messages)} messages for conversation {self._conversation_id}")
-        except Exception as e:
-            logger.error(f"Error loading messages: {e}")
-            self.messages = []
-    
-    @property
-    def memory_variables(self) -> List[str]:
-        """Return the memory variables."""
-        return ["chat_history", "summary"]
-    
-    def load_memory_variables(self, inputs: Dict[str, any]) -> Dict[str, any]:
-        """Load memory variables."""
-        # Get conversation summary
-        summary_data = self._database_service.get_conversation_summary(self._conversation_id)
-        summary = summary_data.get('learning_progress', '') if summary_data else ''
-        
-        # Format chat history
-        chat_history = ""
-        if self.messages:
-            chat_history = "\n".join([
-                f"{'Human' if isinstance(msg, HumanMessage) else 'Assistant'}: {msg.content}"
-                for msg in self.messages[-10:]  # Last 10 messages
-            ])
-        
-        return {
-            "chat_history": chat_history,
-            "summary": summary
-        }
-    
-    def save_context(self, inputs: Dict[str, any], outputs: Dict[str, str]) -> None:
-        """Save context from this conversation to memory."""
-        # Add new messages to memory
-        if "input" in inputs:
-            self.messages.append(HumanMessage(content=inputs["input"]))
-        
-        if "output" in outputs:
-            self.messages.append(AIMessage(content=outputs["output"]))
-        
-        # Save to database
-        try:
-            if "input" in inputs:
-                self._database_service.add_message(
-                    self._conversation_id, "user", inputs["input"]
-                )
-            
-            if "output" in outputs:
-                self._database_service.add_message(
-                    self._conversation_id, "assistant", outputs["output"]
-                )
-        except Exception as e:
-            logger.error(f"Error saving context to database: {e}")
+# Stored messages replayed into a conversation's summary memory when it is rebuilt
+MEMORY_RESTORE_MESSAGES = 10
+# Labels for retrieved snippets; anything that isn't a user message is the assistant
+CONTEXT_ROLE_LABELS = {"user": "User"}
+# Greetings and acknowledgements that earlier messages can't inform; retrieval is skipped for them
+SMALL_TALK_PATTERN = re.compile(
+    r"(hi|hello|hey|thanks|thank you|thx|ok|okay|cool|great|bye|goodbye)( there)?[\s!.?]*",
+    re.IGNORECASE,
+)
+
+# Static system prompt; only bot name and persona vary, so the formatted
+# prompt is cached per persona and stays byte-identical across turns. Keeping
+# per-turn content (history, context) out of it lets Gemini's implicit prefix
+# caching reuse the processed system instruction between calls.
+SYSTEM_PROMPT_PREFIX = (
+    "You are an AI tutor named {bot_name}, acting as {persona}. "
+    "Use the prior conversation history to remain consistent. "
+    "The output should be in markdown format (make sure the bullets are properly formatted without new lines issues if there are any) , and should use an educational tone.\n\n"
+    "*** CRITICAL SAFETY RULES ***\n"
+    "1. Do Not Provide Harmful or Unqualified Advice: You must never give medical, financial, or legal advice. Stick to your role as a tutor.\n"
+    "2. Maintain a Safe and Appropriate Tone: All responses must be family-friendly, positive, and respectful. Do not generate offensive or inappropriate content.\n"
+    "3. Promote Learning, Do Not Cheat: Your goal is to help the user learn. Guide them with questions and explanations. Do not give away final answers to assignments or write their work for them.\n"
+    "4. Protect User Privacy: Do not ask for or store any personal information like names, emails, or addresses.\n"
+    "*** END OF RULES ***\n\n"
+    "Your primary goal is to be helpful and accurate. I will provide you with context from our discussion to help you answer the user's question."
+)
+
+@lru_cache(maxsize=256)
+def system_prompt_prefix(bot_name: str, persona: str) -> str:
+    """Return the system prompt prefix for a bot name and persona."""
+    return SYSTEM_PROMPT_PREFIX.format(bot_name=bot_name, persona=persona)
+
+@lru_cache(maxsize=8)
+def token_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    """Return a tiktoken encoding, building its BPE tables only once per process."""
+    return tiktoken.get_encoding(encoding_name)
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Return the approximate token count of a text, memoized per distinct string."""
+    return len(token_encoding().encode(text))
+
+class LocallyCountedGemini(ChatGoogleGenerativeAI):
+    """Gemini chat model that estimates token counts locally instead of calling the count_tokens API."""
     
-    def clear(self) -> None:
-        """Clear memory contents."""
-        self.messages = []
+    def get_num_tokens(self, text: str) -> int:
+        # Summary memory recounts its whole buffer message by message after every
+        # turn (and on each pruning step), so only newly added messages miss the
+        # cache; an approximate local count is enough for that threshold
+        return count_tokens(text)
+
+def compose_input(query: str, rag_context: str = "") -> str:
+    """Return the human turn for a question and its retrieved context, as recorded in memory."""
+    return f"Relevant context (may be empty):\n{rag_context}\n\nCurrent Question: {query}"
 
 class ChainService:
     """Service for managing LangChain conversation chains"""
@@ -114,124 +84,224 @@ class ChainService:
         self.database_service = database_service
         self.vector_service = vector_service
         
-        # Memory cache: conversation_id -> ConversationSummaryBufferMemory
-        self.memory_cache = {}
+        # Memory cache: conversation_id -> ConversationSummaryBufferMemory,
+        # bounded so idle conversations don't keep their memory alive forever
+        self.memory_cache = LRUCache(maxsize=int(os.getenv("MEMORY_CACHE_MAX", "512")))
+        # conversation_id -> in-flight restore, so concurrent misses build one memory
+        self.memory_restores: Dict[str, asyncio.Task] = {}
+        
+        # Response cache: (conversation_id, model) -> recent (query embedding, response)
+        # pairs. A question this close to one the same model already answered in
+        # the conversation reuses that answer instead of calling Gemini again.
+        # Opt-in: matching ignores the history, so follow-ups like "Why?" would
+        # get an earlier, unrelated answer; unset RESPONSE_CACHE_THRESHOLD disables it
+        self.response_cache = LRUCache(maxsize=1024)
+        self.response_cache_size = 32
+        threshold = os.getenv("RESPONSE_CACHE_THRESHOLD")
+        self.response_cache_threshold = float(threshold) if threshold else None
+        
+        # Prompt cache: sha256 of model + formatted messages -> response. Exactly
+        # repeated prompts (e.g. the same opening question to the same persona in
+        # different conversations) are answered without calling Gemini
+        self.prompt_cache = TTLCache(maxsize=1024, ttl=int(os.getenv("PROMPT_CACHE_TTL", "3600")))
+        
+        # Bounded pool for blocking work (embedding, FAISS search) so a burst of
+        # turns cannot starve the threads FastAPI uses for database calls
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="chain-service")
+        # Single writer for post-turn persistence/indexing: turns are stored in
+        # the order they finished, without a new thread per turn
+        self.post_turn_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chain-post-turn")
         
         # Initialize Google Generative AI
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
         
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",
+        self.default_model_name = "gemini-1.5-flash"
+        self.llm = LocallyCountedGemini(
+            model=self.default_model_name,
             google_api_key=api_key,
             temperature=0.7,
             max_output_tokens=2048
         )
         
-       
+        # LLM cache: model name -> ChatGoogleGenerativeAI, so switching models
+        # per request reuses the client (and its connections) instead of rebuilding it
+        self.llm_cache = LRUCache(maxsize=16)
+        
+        # Load the tokenizer now rather than on the first turn's memory update
+        token_encoding()
         
         logger.info("ChainService initialized successfully")
     
-    def get_or_create_memory_for_conversation(self, conversation_id: str) -> ConversationSummaryBufferMemory:
-        """Get or create a ConversationSummaryBufferMemory for a conversation (with caching)."""
-        if conversation_id not in self.memory_cache:
-            logger.info(f"Creating new ConversationSummaryBufferMemory for conversation {conversation_id}")
-            # Use same LLM for summarization; memory_key defaults to "history"
-            self.memory_cache[conversation_id] = ConversationSummaryBufferMemory(
-                llm=self.llm,
-                max_token_limit=2000,
-                memory_key="history",
-                return_messages=False,
+    async def _run_blocking(self, func, *args):
+        """Run a blocking call on the service's thread pool without stalling the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    
+    def _get_llm(self, model_name: Optional[str]) -> ChatGoogleGenerativeAI:
+        """Return the cached LLM for a model, creating it on first use."""
+        if not model_name or model_name == self.default_model_name:
+            return self.llm
+        llm = self.llm_cache.get(model_name)
+        if llm is None:
+            llm = LocallyCountedGemini(
+                model=model_name,
+                google_api_key=os.getenv("GEMINI_API_KEY"),
+                temperature=0.7,
+                max_output_tokens=2048,
             )
-        return self.memory_cache[conversation_id]
+            self.llm_cache[model_name] = llm
+        return llm
+    
+    def shutdown(self):
+        """Release the service's worker threads, finishing queued post-turn writes."""
+        self.executor.shutdown(wait=False)
+        self.post_turn_executor.shutdown(wait=True)
+    
+    def _new_memory(self, recent_messages: List[Dict]) -> ConversationSummaryBufferMemory:
+        """Build a ConversationSummaryBufferMemory seeded with a conversation's latest stored messages."""
+        # Use same LLM for summarization; memory_key defaults to "history"
+        memory = ConversationSummaryBufferMemory(
+            llm=self.llm,
+            max_token_limit=2000,
+            memory_key="history",
+            return_messages=False,
+        )
+        for msg in recent_messages:
+            if msg['role'] == 'user':
+                memory.chat_memory.add_user_message(msg['content'])
+            elif msg['role'] == 'assistant':
+                memory.chat_memory.add_ai_message(msg['content'])
+        return memory
     
-    def invoke_chain(self, conversation_id: str, query: str, persona: Dict, model_name: str = "gemini-1.5-flash") -> Dict:
-        """Invoke the conversation chain for a single turn using ConversationChain with CSBM."""
+    async def _restore_memory(self, conversation_id: str) -> ConversationSummaryBufferMemory:
+        """Rebuild a conversation's memory from its stored messages and cache it."""
+        logger.info("Creating new ConversationSummaryBufferMemory for conversation %s", conversation_id)
+        # Conversations evicted from the cache (or from before a restart) resume
+        # from their latest stored messages; only the read leaves the event loop,
+        # so the cache itself is never touched from another thread
+        recent_messages = []
         try:
-            import time
-            start_time = time.time()
-            
-            # Create a fresh LLM instance if the model name differs
-            llm = self.llm
-            try:
-                current_model_name = getattr(self.llm, "model_name", getattr(self.llm, "model", None))
-            except Exception:
-                current_model_name = None
-            if model_name and model_name != current_model_name:
-                llm = ChatGoogleGenerativeAI(
-                    model=model_name,
-                    google_api_key=os.getenv("GEMINI_API_KEY"),
-                    temperature=0.7,
-                    max_output_tokens=2048,
-                )
-            
-            # Get or create memory object from cache
-            memory = self.get_or_create_memory_for_conversation(conversation_id)
-            
-            # Get relevant context from vector service
-            rag_context = self._get_relevant_context(conversation_id, query)
-            
-            # Log context retrieval
-            # if rag_context:
-            #     logger.info("=" * 80)
-            #     logger.info("RELEVANT CONTEXT RETRIEVED:")
-            #     logger.info("=" * 80)
-            #     logger.info(rag_context)
-            #     logger.info("=" * 80)
-            # else:
-            #     logger.info("No relevant context found for this query")
-            
-            
-            # Compose a single input string that includes persona, bot name, and RAG context
-            bot_name = persona.get("bot_name", "AI Tutor")
-            persona_desc = persona.get("persona", "helpful AI Tutor")
-            composed_input = (
-                # f"Bot name: {bot_name}.\n"
-                # f"Persona: {persona_desc}.\n"
-                f"Relevant context (may be empty):\n{rag_context if rag_context else ''}\n\n"
-                f"Current Question: {query}"
+            recent_messages = await self._run_blocking(
+                self.database_service.get_recent_messages, conversation_id, MEMORY_RESTORE_MESSAGES
             )
-            # Create the prompt template using only {history} and {input} to be compatible with ConversationChain
-            system_content = (
-                f"You are an AI tutor named {bot_name}, acting as {persona_desc}. "
-                "Use the prior conversation history to remain consistent. "
-                "The output should be in markdown format (make sure the bullets are properly formatted without new lines issues if there are any) , and should use an educational tone.\n\n"
-                "*** CRITICAL SAFETY RULES ***\n"
-                "1. Do Not Provide Harmful or Unqualified Advice: You must never give medical, financial, or legal advice. Stick to your role as a tutor.\n"
-                "2. Maintain a Safe and Appropriate Tone: All responses must be family-friendly, positive, and respectful. Do not generate offensive or inappropriate content.\n"
-                "3. Promote Learning, Do Not Cheat: Your goal is to help the user learn. Guide them with questions and explanations. Do not give away final answers to assignments or write their work for them.\n"
-                "4. Protect User Privacy: Do not ask for or store any personal information like names, emails, or addresses.\n"
-                "*** END OF RULES ***\n\n"
-                "Your primary goal is to be helpful and accurate. I will provide you with context from our discussion to help you answer the user's question.\n\n"
-                "Conversation history (summarized as needed):\n{history}\n"
+        except Exception as e:
+            logger.error("Error restoring memory for conversation %s: %s", conversation_id, e)
+        memory = self._new_memory(recent_messages)
+        self.memory_cache[conversation_id] = memory
+        return memory
+    
+    async def _get_memory(self, conversation_id: str) -> ConversationSummaryBufferMemory:
+        """Return the cached memory, restoring it on a miss (concurrent misses share one restore)."""
+        memory = self.memory_cache.get(conversation_id)
+        if memory is not None:
+            return memory
+        restore = self.memory_restores.get(conversation_id)
+        if restore is None:
+            restore = asyncio.create_task(self._restore_memory(conversation_id))
+            self.memory_restores[conversation_id] = restore
+            restore.add_done_callback(lambda _: self.memory_restores.pop(conversation_id, None))
+        # Shielded so one cancelled request doesn't abort the restore others await
+        return await asyncio.shield(restore)
+    
+    async def _prepare_turn(self, conversation_id: str, query: str, persona: Dict, model_name: str,
+                            query_embedding: Optional[np.ndarray] = None):
+        """Assemble the LLM, memory, formatted prompt messages and composed input for a single turn."""
+        # Start retrieval first: the search runs in a worker thread (reusing the
+        # response-cache embedding) while the LLM, memory and prompt are assembled below.
+        # Small talk gets no retrieved context, so it skips the search entirely
+        rag_task = None
+        if not SMALL_TALK_PATTERN.fullmatch(query.strip()):
+            rag_task = asyncio.create_task(
+                self._run_blocking(self._get_relevant_context, conversation_id, query, query_embedding)
             )
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_content),
-                ("human", "{input}")
-            ])
+        
+        # Reuse the client for the requested model (created on first use)
+        llm = self._get_llm(model_name)
+        
+        # Get or create memory object from cache
+        memory = await self._get_memory(conversation_id)
+        
+        # Load the summarized history once per turn while retrieval is still running
+        memory_variables = await memory.aload_memory_variables({})
+        
+        # Get relevant context from vector service (started above)
+        rag_context = await rag_task if rag_task else ""
+        
+        # Log context retrieval (debug only; skipped entirely at higher levels)
+        if logger.isEnabledFor(logging.DEBUG):
+            if rag_context:
+                logger.debug("=" * 80)
+                logger.debug("RELEVANT CONTEXT RETRIEVED:")
+                logger.debug("=" * 80)
+                logger.debug(rag_context)
+                logger.debug("=" * 80)
+            else:
+                logger.debug("No relevant context found for this query")
+        
+        # Compose a single input string that includes the RAG context
+        composed_input = compose_input(query, rag_context)
+        
+        system_prefix = system_prompt_prefix(
+            persona.get("bot_name", "AI Tutor"),
+            persona.get("persona", "helpful AI Tutor"),
+        )
+        # Static instruction first, then everything that changes per turn
+        messages = [
+            SystemMessage(content=system_prefix),
+            HumanMessage(content=(
+                f"Conversation history (summarized as needed):\n{memory_variables['history']}\n\n"
+                f"{composed_input}"
+            )),
+        ]
+        
+        return llm, memory, messages, composed_input, rag_context
+    
+    async def invoke_chain(self, conversation_id: str, query: str, persona: Dict, model_name: str = "gemini-1.5-flash") -> Dict:
+        """Invoke the LLM for a single turn using the cached system prompt with CSBM."""
+        try:
+            start_time = perf_counter()
             
+            # The cache check's embedding overlaps with loading (or restoring) the memory
+            (query_embedding, cached_response), _ = await asyncio.gather(
+                self._check_response_cache(conversation_id, model_name, query),
+                self._get_memory(conversation_id),
+            )
+            if cached_response is not None:
+                await self._record_cached_turn(conversation_id, query, cached_response)
+                return {
+                    "response": cached_response,
+                    "response_time": perf_counter() - start_time,
+                    "success": True,
+                    "context_used": False,
+                    "model": model_name
+                }
             
-            # Create ConversationChain with memory and prompt
-            conversation_chain = ConversationChain(
-                llm=llm,
-                prompt=prompt,
-                memory=memory,
-                verbose=False,
+            llm, memory, messages, composed_input, rag_context = await self._prepare_turn(
+                conversation_id, query, persona, model_name, query_embedding
             )
-            # Invoke the chain with ONLY the new inputs for this turn
-            invoke_inputs = {"input": composed_input}
-            result = conversation_chain.invoke(invoke_inputs)
-            response_text = result.get("response") if isinstance(result, dict) else str(result)
+            
+            # Call the LLM with the pre-formatted messages unless this exact
+            # prompt was answered recently; the async path awaits Gemini on the
+            # event loop instead of blocking a thread
+            prompt_key = self._prompt_key(model_name, messages)
+            response_text = self.prompt_cache.get(prompt_key)
+            if response_text is None:
+                result = await llm.ainvoke(messages)
+                response_text = result.content
+                if response_text:
+                    self.prompt_cache[prompt_key] = response_text
+            else:
+                logger.info("Prompt cache hit for conversation %s", conversation_id)
+            self._store_response(conversation_id, model_name, query_embedding, response_text)
+            
+            # Record the turn in the summary buffer memory
+            await memory.asave_context({"input": composed_input}, {"response": response_text})
 
             # Defer DB persistence and vector indexing to background for lower latency
-            threading.Thread(
-                target=self._post_turn_tasks,
-                args=(conversation_id, query, response_text),
-                daemon=True,
-            ).start()
+            self._schedule_post_turn_tasks(conversation_id, query, response_text)
             
-            response_time = time.time() - start_time
+            response_time = perf_counter() - start_time
             
             return {
                 "response": response_text,
@@ -242,7 +312,7 @@ class ChainService:
             }
             
         except Exception as e:
-            logger.error(f"Error in chain invocation: {e}")
+            logger.error("Error in chain invocation: %s", e)
             return {
                 "response": f"Sorry, I encountered an error: {str(e)}",
                 "response_time": 0,
@@ -252,140 +322,165 @@ class ChainService:
                 "model": model_name
             }
     
+    async def stream_chain(self, conversation_id: str, query: str, persona: Dict, model_name: str = "gemini-1.5-flash") -> AsyncIterator[str]:
+        """Stream the response for a single turn chunk by chunk as Gemini produces it."""
+        try:
+            # The cache check's embedding overlaps with loading (or restoring) the memory
+            (query_embedding, cached_response), _ = await asyncio.gather(
+                self._check_response_cache(conversation_id, model_name, query),
+                self._get_memory(conversation_id),
+            )
+            if cached_response is not None:
+                await self._record_cached_turn(conversation_id, query, cached_response)
+                yield cached_response
+                return
+            
+            llm, memory, messages, composed_input, rag_context = await self._prepare_turn(
+                conversation_id, query, persona, model_name, query_embedding
+            )
+            
+            prompt_key = self._prompt_key(model_name, messages)
+            response_text = self.prompt_cache.get(prompt_key)
+            if response_text is None:
+                chunks = []
+                async for chunk in llm.astream(messages):
+                    if chunk.content:
+                        chunks.append(chunk.content)
+                        yield chunk.content
+                response_text = "".join(chunks)
+                if response_text:
+                    self.prompt_cache[prompt_key] = response_text
+            else:
+                logger.info("Prompt cache hit for conversation %s", conversation_id)
+                yield response_text
+            self._store_response(conversation_id, model_name, query_embedding, response_text)
+            
+            # Record the turn in the summary buffer memory
+            await memory.asave_context({"input": composed_input}, {"response": response_text})
+            self._schedule_post_turn_tasks(conversation_id, query, response_text)
+            
+        except Exception as e:
+            logger.error("Error in chain streaming: %s", e)
+            yield f"Sorry, I encountered an error: {str(e)}"
+    
+    def _prompt_key(self, model_name: Optional[str], messages: List[BaseMessage]) -> str:
+        """Hash the model and formatted messages into an exact-match prompt cache key."""
+        digest = hashlib.sha256((model_name or self.default_model_name).encode())
+        for message in messages:
+            digest.update(b"\0" + message.type.encode() + b"\0" + message.content.encode())
+        return digest.hexdigest()
+    
+    async def _check_response_cache(self, conversation_id: str, model_name: Optional[str], query: str) -> Tuple[Optional[np.ndarray], Optional[str]]:
+        """Embed the query and return it with a cached response to a near-identical question, if any."""
+        if self.response_cache_threshold is None:
+            # Disabled: retrieval embeds the query itself
+            return None, None
+        try:
+            query_embedding = await self._run_blocking(self.vector_service.embed_query, query)
+            query_embedding = query_embedding / (np.linalg.norm(query_embedding) or 1.0)
+        except Exception as e:
+            logger.error("Error embedding query for response cache: %s", e)
+            return None, None
+        
+        entries = self.response_cache.get((conversation_id, model_name or self.default_model_name))
+        if not entries:
+            return query_embedding, None
+        
+        # Embeddings are unit length, so the dot product is the cosine similarity
+        scores = np.stack([embedding for embedding, _ in entries]) @ query_embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.response_cache_threshold:
+            return query_embedding, None
+        
+        logger.info("Response cache hit for conversation %s (similarity %.3f)", conversation_id, scores[best])
+        return query_embedding, entries[best][1]
+    
+    def _store_response(self, conversation_id: str, model_name: Optional[str], query_embedding: Optional[np.ndarray], response_text: str) -> None:
+        """Remember a generated response for near-duplicate questions later in the conversation."""
+        if query_embedding is None or not response_text:
+            return
+        key = (conversation_id, model_name or self.default_model_name)
+        entries = self.response_cache.get(key)
+        if entries is None:
+            entries = deque(maxlen=self.response_cache_size)
+            self.response_cache[key] = entries
+        entries.append((query_embedding, response_text))
+    
+    async def _record_cached_turn(self, conversation_id: str, query: str, response_text: str) -> None:
+        """Keep memory, database and vector index in step when a turn is answered from cache."""
+        memory = await self._get_memory(conversation_id)
+        # Same input shape as a generated turn; no context was retrieved for it
+        await memory.asave_context({"input": compose_input(query)}, {"response": response_text})
+        self._schedule_post_turn_tasks(conversation_id, query, response_text)
+    
+    def _schedule_post_turn_tasks(self, conversation_id: str, user_query: str, assistant_response: str) -> None:
+        """Run post-turn persistence and indexing without delaying the response."""
+        self.post_turn_executor.submit(
+            self._post_turn_tasks, conversation_id, user_query, assistant_response
+        )
+    
     def _post_turn_tasks(self, conversation_id: str, user_query: str, assistant_response: str) -> None:
         """Persist messages and update vector index in background."""
         try:
-            # Persist this turn's exchange to the database
+            # Persist this turn's exchange to the database in a single transaction
+            stored_messages = []
             try:
-                self.database_service.add_message(conversation_id, "user", user_query)
-                self.database_service.add_message(conversation_id, "assistant", assistant_response)
+                stored_messages = self.database_service.add_messages(conversation_id, [
+                    ("user", user_query),
+                    ("assistant", assistant_response),
+                ])
             except Exception as db_err:
-                logger.error(f"Error persisting messages to database: {db_err}")
+                logger.error("Error persisting messages to database: %s", db_err)
 
-            # Update vector index with the new messages
-            try:
-                self._update_vector_index(conversation_id, user_query, assistant_response)
-            except Exception as vec_err:
-                logger.error(f"Error updating vector index: {vec_err}")
+            # Update vector index with the messages just stored
+            if stored_messages:
+                self._update_vector_index(conversation_id, stored_messages)
         except Exception as e:
-            logger.error(f"Error in post-turn tasks: {e}")
+            logger.error("Error in post-turn tasks: %s", e)
 
-    def _get_relevant_context(self, conversation_id: str, query: str) -> str:
+    def _get_relevant_context(self, conversation_id: str, query: str, query_embedding: Optional[np.ndarray] = None) -> str:
         """Get relevant context from vector service"""
         try:
             similar_messages = self.vector_service.search_similar_messages(
-                conversation_id, query, k=3, min_score=0.3
+                conversation_id, query, k=3, min_score=0.3, query_embedding=query_embedding
             )
             
             if not similar_messages:
                 return ""
             
-            context_parts = []
-            for msg in similar_messages:
-                role = "User" if msg['role'] == 'user' else "Assistant"
-                content = msg['content_preview']
-                context_parts.append(f"{role}: {content}")
+            # Most turns retrieve a single snippet; skip the join for that case
+            if len(similar_messages) == 1:
+                msg = similar_messages[0]
+                return f"{CONTEXT_ROLE_LABELS.get(msg['role'], 'Assistant')}: {msg['content_preview']}"
             
-            return "\n".join(context_parts)
+            return "\n".join(
+                f"{CONTEXT_ROLE_LABELS.get(msg['role'], 'Assistant')}: {msg['content_preview']}"
+                for msg in similar_messages
+            )
             
         except Exception as e:
-            logger.error(f"Error getting relevant context: {e}")
+            logger.error("Error getting relevant context: %s", e)
             return ""
     
-    def _update_vector_index(self, conversation_id: str, user_query: str, assistant_response: str):
-        """Update vector index with new messages"""
+    def _update_vector_index(self, conversation_id: str, messages: List[Dict]):
+        """Update vector index with newly stored messages"""
         try:
-            # Get the latest messages from database
-            messages = self.database_service.get_conversation_messages(conversation_id)
-            
-            # Convert to vector service format
-            vector_messages = []
-            for msg in messages[-2:]:  # Last 2 messages (user query + assistant response)
-                vector_messages.append({
-                    'id': msg['id'],
-                    'role': msg['role'],
-                    'content': msg['content'],
-                    'timestamp': msg['timestamp']
-                })
-            
-            # Add to vector service
-            if vector_messages:
-                self.vector_service.add_messages(conversation_id, vector_messages)
-                
-        except Exception as e:
-            logger.error(f"Error updating vector index: {e}")
-    
-    def _update_conversation_summary(self, conversation_id: str, user_query: str, assistant_response: str):
-        """Update conversation summary using LLM"""
-        try:
-            # Get existing summary
-            summary_data = self.database_service.get_conversation_summary(conversation_id)
-            old_summary = summary_data.get('learning_progress', '') if summary_data else ''
-            
-            # Create summary update prompt
-            summary_prompt = f"""You are tasked with updating a conversation summary. 
-
-Current Summary:
-{old_summary if old_summary else "No previous summary available."}
-
-Latest Exchange:
-User: {user_query}
-Assistant: {assistant_response}
-
-Please create a new, concise summary (under 200 words) that:
-1. Integrates the new exchange into the existing summary
-2. Maintains the key topics and learning progress
-3. Focuses on the most important information
-4. Is written in a clear, educational tone
-
-New Summary:"""
-            
-            # Log the summary generation prompt
-            # logger.info("=" * 80)
-            # logger.info("SUMMARY GENERATION PROMPT:")
-            # logger.info("=" * 80)
-            # logger.info(summary_prompt)
-            # logger.info("=" * 80)
-            
-            # Generate new summary
-            summary_response = self.llm.invoke(summary_prompt)
-            new_summary = summary_response.content.strip()
-            
-            # Log the generated summary
-            # logger.info("=" * 80)
-            # logger.info("GENERATED SUMMARY:")
-            # logger.info("=" * 80)
-            # logger.info(new_summary)
-            # logger.info("=" * 80)
-            
-            # Save to database
-            self.database_service.update_conversation_summary(
-                conversation_id=conversation_id,
-                topics=[],  # Could be extracted later if needed
-                key_questions=[user_query],  # Add current question
-                learning_progress=new_summary
-            )
-            
-            logger.info(f"Summary updated for conversation {conversation_id}")
-            
+            self.vector_service.add_messages(conversation_id, messages)
         except Exception as e:
-            logger.error(f"Error updating conversation summary: {e}")
+            logger.error("Error updating vector index: %s", e)
     
-    def validate_api_key(self, model_name: str = "gemini-1.5-flash") -> bool:
+    async def validate_api_key(self, model_name: str = "gemini-1.5-flash") -> bool:
         """Validate that the API key is working"""
         try:
-            # Create a test LLM instance with the specified model
-            test_llm = ChatGoogleGenerativeAI(
-                model=model_name,
-                google_api_key=os.getenv("GEMINI_API_KEY"),
-                temperature=0.7,
-                max_output_tokens=100
-            )
+            # Probe through the cached client, so the same call opens the
+            # connection that chat turns will reuse
+            test_llm = self._get_llm(model_name)
             
-            # Test with a simple query
-            response = test_llm.invoke("Hello")
+            # A one-token generation is enough to prove the key works, without
+            # waiting for (or paying for) a full reply
+            await test_llm.ainvoke("Hello", generation_config={"max_output_tokens": 1})
             
             return True
         except Exception as e:
-            logger.error(f"API key validation failed: {e}")
+            logger.error("API key validation failed: %s", e)
             return False
@@ -1,21 +1,127 @@
 import sqlite3
 import uuid
-import json
-from typing import List, Dict, Optional, Tuple
-from datetime import datetime
+from typing import Iterator, List, Dict, Optional, Tuple
+from datetime import datetime, timezone
 import logging
+import queue
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Applied to every connection: WAL lets readers run alongside the writer and,
+# with synchronous=NORMAL, commits no longer fsync the database on every write
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16384",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA foreign_keys = ON",
+)
+
+# SQL for the per-turn paths, shared as constants so each connection's statement
+# cache reuses the prepared statement instead of parsing the text again
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (id, conversation_id, role, content, timestamp, tokens_used)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+SELECT_MESSAGES_SQL = """
+    SELECT id, role, content, timestamp, tokens_used
+    FROM messages 
+    WHERE conversation_id = ?
+    ORDER BY timestamp ASC, rowid ASC
+"""
+# rowid breaks ties between messages written in the same second
+SELECT_RECENT_MESSAGES_SQL = """
+    SELECT id, role, content, timestamp, tokens_used
+    FROM messages 
+    WHERE conversation_id = ?
+    ORDER BY timestamp DESC, rowid DESC
+    LIMIT ?
+"""
+SELECT_CONVERSATION_SQL = """
+    SELECT id, session_id, bot_name, persona, model, created_at, updated_at
+    FROM conversations 
+    WHERE id = ?
+"""
+
 class DatabaseService:
-    def __init__(self, db_path: str = "conversations.db"):
+    def __init__(self, db_path: str = "conversations.db", reader_pool_size: int = 8):
         self.db_path = db_path
+        # Long-lived connections keep SQLite's page cache and parsed schema warm
+        # instead of reopening the database on every call. All writes go through
+        # one writer connection (serialized by a lock); reads borrow one of a
+        # fixed pool of read-only connections, which WAL lets run alongside the
+        # writer. The pool is not tied to threads, so the threadpool retiring and
+        # replacing idle workers never opens more connections.
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer_conn = self._open(self.db_path)
+        # Transactions on the writer are explicit: see _writer()
+        self._writer_conn.isolation_level = None
         self.init_database()
+        
+        # Readers open after init so the database file and WAL mode exist
+        reader_uri = f"{Path(db_path).resolve().as_uri()}?mode=ro"
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=reader_pool_size)
+        for _ in range(reader_pool_size):
+            self._readers.put(self._open(reader_uri, uri=True))
+    
+    def _open(self, database: str, uri: bool = False) -> sqlite3.Connection:
+        """Open a connection with the service's PRAGMAs applied and track it for close()"""
+        conn = sqlite3.connect(database, uri=uri, check_same_thread=False, cached_statements=256)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        # Rows map column names straight to values, so results become dicts
+        # without hand-built key lists
+        conn.row_factory = sqlite3.Row
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+    
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a read-only connection from the pool (waiting if all are in use)"""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    @contextmanager
+    def _writer(self) -> Iterator[sqlite3.Connection]:
+        """Hold the writer connection for one transaction (committed or rolled back on exit)"""
+        with self._write_lock:
+            conn = self._writer_conn
+            # BEGIN IMMEDIATE takes the write lock up front, so a transaction
+            # never fails halfway through on a read-to-write lock upgrade
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+    
+    def close(self):
+        """Close every connection opened by the service"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
     
     def init_database(self):
         """Initialize database tables if they don't exist"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            # WAL is stored in the database file, so setting it once is enough
+            # (and it can't be changed inside a transaction)
+            self._writer_conn.execute("PRAGMA journal_mode = WAL")
+            
+            with self._writer() as conn:
                 cursor = conn.cursor()
                 
                 # Create conversations table
@@ -27,7 +133,9 @@ class DatabaseService:
                         persona TEXT NOT NULL,
                         model TEXT NOT NULL,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        message_count INTEGER DEFAULT 0,
+                        last_message_at TIMESTAMP
                     )
                 """)
                 
@@ -56,7 +164,57 @@ class DatabaseService:
                     )
                 """)
                 
-                conn.commit()
+                # Index the per-conversation and per-session lookups so they are
+                # range scans in the requested order rather than scan + sort
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp
+                    ON messages (conversation_id, timestamp)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_conversations_session_updated
+                    ON conversations (session_id, updated_at DESC)
+                """)
+                
+                # Older databases predate the message counters; add and backfill them once
+                columns = {row['name'] for row in cursor.execute("PRAGMA table_info(conversations)")}
+                if 'message_count' not in columns:
+                    cursor.execute("ALTER TABLE conversations ADD COLUMN message_count INTEGER DEFAULT 0")
+                    cursor.execute("ALTER TABLE conversations ADD COLUMN last_message_at TIMESTAMP")
+                    cursor.execute("""
+                        UPDATE conversations SET
+                            message_count = (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id),
+                            last_message_at = (SELECT MAX(timestamp) FROM messages WHERE conversation_id = conversations.id)
+                    """)
+                
+                # Keep the conversation's updated_at, message count and last
+                # message time current inside SQLite whenever a message is added,
+                # so inserts are a single statement each and listings never
+                # aggregate over messages. Messages are only ever deleted along
+                # with their conversation, so deletes need no counterpart.
+                cursor.execute("""
+                    CREATE TRIGGER IF NOT EXISTS trg_messages_after_insert
+                    AFTER INSERT ON messages
+                    BEGIN
+                        UPDATE conversations 
+                        SET updated_at = CURRENT_TIMESTAMP,
+                            message_count = message_count + 1,
+                            last_message_at = NEW.timestamp
+                        WHERE id = NEW.conversation_id;
+                    END
+                """)
+                
+                # Cascade conversation deletes to messages and summaries. Existing
+                # tables can't gain ON DELETE CASCADE without a rebuild, so a
+                # trigger does it; it runs before the parent row's foreign key check
+                cursor.execute("""
+                    CREATE TRIGGER IF NOT EXISTS trg_conversations_cascade_delete
+                    BEFORE DELETE ON conversations
+                    BEGIN
+                        DELETE FROM messages WHERE conversation_id = OLD.id;
+                        DELETE FROM conversation_summaries WHERE conversation_id = OLD.id;
+                    END
+                """)
+                
                 logger.info("Database initialized successfully")
                 
         except Exception as e:
@@ -67,94 +225,81 @@ class DatabaseService:
         """Create a new conversation and return its ID"""
         conversation_id = str(uuid.uuid4())
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._writer() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO conversations (id, session_id, bot_name, persona, model)
                     VALUES (?, ?, ?, ?, ?)
                 """, (conversation_id, session_id, bot_name, persona, model))
-                conn.commit()
                 logger.info(f"Created conversation {conversation_id} for session {session_id}")
                 return conversation_id
         except Exception as e:
             logger.error(f"Failed to create conversation: {e}")
             raise
     
-    def add_message(self, conversation_id: str, role: str, content: str, tokens_used: int = 0) -> str:
-        """Add a message to a conversation and return its ID"""
-        message_id = str(uuid.uuid4())
+    def add_messages(self, conversation_id: str, messages: List[Tuple[str, str]]) -> List[Dict]:
+        """Add several (role, content) messages to a conversation in one transaction and return the stored rows"""
+        # Stamp rows here (same UTC format as CURRENT_TIMESTAMP) so callers get
+        # them back without reading the messages again
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        rows = [
+            {
+                'id': str(uuid.uuid4()),
+                'role': role,
+                'content': content,
+                'timestamp': timestamp
+            }
+            for role, content in messages
+        ]
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO messages (id, conversation_id, role, content, tokens_used)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (message_id, conversation_id, role, content, tokens_used))
-                
-                # Update conversation's updated_at timestamp
-                cursor.execute("""
-                    UPDATE conversations 
-                    SET updated_at = CURRENT_TIMESTAMP 
-                    WHERE id = ?
-                """, (conversation_id,))
+            with self._writer() as conn:
+                # One write transaction (and one commit) for the whole batch
+                # The insert trigger updates the conversation's updated_at timestamp
+                conn.executemany(INSERT_MESSAGE_SQL, [
+                    (row['id'], conversation_id, row['role'], row['content'], row['timestamp'], 0)
+                    for row in rows
+                ])
                 
-                conn.commit()
-                logger.info(f"Added message {message_id} to conversation {conversation_id}")
-                return message_id
+                logger.info(f"Added {len(rows)} messages to conversation {conversation_id}")
+                return rows
         except Exception as e:
-            logger.error(f"Failed to add message: {e}")
+            logger.error(f"Failed to add messages: {e}")
             raise
     
     def get_conversation_messages(self, conversation_id: str) -> List[Dict]:
         """Get all messages for a conversation"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT id, role, content, timestamp, tokens_used
-                    FROM messages 
-                    WHERE conversation_id = ?
-                    ORDER BY timestamp ASC
-                """, (conversation_id,))
+            with self._reader() as conn:
+                cursor = conn.execute(SELECT_MESSAGES_SQL, (conversation_id,))
                 
-                messages = []
-                for row in cursor.fetchall():
-                    messages.append({
-                        'id': row[0],
-                        'role': row[1],
-                        'content': row[2],
-                        'timestamp': row[3],
-                        'tokens_used': row[4]
-                    })
+                messages = [dict(row) for row in cursor.fetchall()]
                 
                 return messages
         except Exception as e:
             logger.error(f"Failed to get conversation messages: {e}")
             raise
     
+    def get_recent_messages(self, conversation_id: str, limit: int) -> List[Dict]:
+        """Get the most recent messages for a conversation, oldest first"""
+        try:
+            with self._reader() as conn:
+                cursor = conn.execute(SELECT_RECENT_MESSAGES_SQL, (conversation_id, limit))
+                
+                messages = [dict(row) for row in reversed(cursor.fetchall())]
+                
+                return messages
+        except Exception as e:
+            logger.error(f"Failed to get recent messages: {e}")
+            raise
+    
     def get_conversation(self, conversation_id: str) -> Optional[Dict]:
         """Get conversation details"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT id, session_id, bot_name, persona, model, created_at, updated_at
-                    FROM conversations 
-                    WHERE id = ?
-                """, (conversation_id,))
+            with self._reader() as conn:
+                cursor = conn.execute(SELECT_CONVERSATION_SQL, (conversation_id,))
                 
                 row = cursor.fetchone()
-                if row:
-                    return {
-                        'id': row[0],
-                        'session_id': row[1],
-                        'bot_name': row[2],
-                        'persona': row[3],
-                        'model': row[4],
-                        'created_at': row[5],
-                        'updated_at': row[6]
-                    }
-                return None
+                return dict(row) if row else None
         except Exception as e:
             logger.error(f"Failed to get conversation: {e}")
             raise
@@ -162,25 +307,17 @@ class DatabaseService:
     def get_session_conversations(self, session_id: str) -> List[Dict]:
         """Get all conversations for a session"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._reader() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
-                    SELECT id, bot_name, persona, model, created_at, updated_at
+                    SELECT id, bot_name, persona, model, created_at, updated_at,
+                           message_count, last_message_at
                     FROM conversations 
                     WHERE session_id = ?
                     ORDER BY updated_at DESC
                 """, (session_id,))
                 
-                conversations = []
-                for row in cursor.fetchall():
-                    conversations.append({
-                        'id': row[0],
-                        'bot_name': row[1],
-                        'persona': row[2],
-                        'model': row[3],
-                        'created_at': row[4],
-                        'updated_at': row[5]
-                    })
+                conversations = [dict(row) for row in cursor.fetchall()]
                 
                 return conversations
         except Exception as e:
@@ -196,101 +333,61 @@ class DatabaseService:
     def delete_conversation(self, conversation_id: str) -> bool:
         """Delete a conversation and all its messages"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Check if conversation exists
-                cursor.execute("SELECT id FROM conversations WHERE id = ?", (conversation_id,))
-                if not cursor.fetchone():
+            with self._writer() as conn:
+                # The delete trigger removes messages and summary; RETURNING
+                # tells us whether the conversation existed
+                row = conn.execute(
+                    "DELETE FROM conversations WHERE id = ? RETURNING id", (conversation_id,)
+                ).fetchone()
+                if row is None:
                     return False
                 
-                # Delete messages first (due to foreign key constraint)
-                cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
-                
-                # Delete conversation summary
-                cursor.execute("DELETE FROM conversation_summaries WHERE conversation_id = ?", (conversation_id,))
-                
-                # Delete conversation
-                cursor.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
-                
-                conn.commit()
                 logger.info(f"Deleted conversation {conversation_id}")
                 return True
         except Exception as e:
             logger.error(f"Failed to delete conversation: {e}")
             raise
     
-    def get_conversation_summary(self, conversation_id: str) -> Optional[Dict]:
-        """Get conversation summary"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT topics, key_questions, learning_progress, last_updated
-                    FROM conversation_summaries 
-                    WHERE conversation_id = ?
-                """, (conversation_id,))
-                
-                row = cursor.fetchone()
-                if row:
-                    return {
-                        'topics': json.loads(row[0]) if row[0] else [],
-                        'key_questions': json.loads(row[1]) if row[1] else [],
-                        'learning_progress': row[2],
-                        'last_updated': row[3]
-                    }
-                return None
-        except Exception as e:
-            logger.error(f"Failed to get conversation summary: {e}")
-            raise
-    
-    def update_conversation_summary(self, conversation_id: str, topics: List[str], 
-                                  key_questions: List[str], learning_progress: str) -> bool:
-        """Update conversation summary"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT OR REPLACE INTO conversation_summaries 
-                    (conversation_id, topics, key_questions, learning_progress, last_updated)
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-                """, (
-                    conversation_id,
-                    json.dumps(topics),
-                    json.dumps(key_questions),
-                    learning_progress
-                ))
-                conn.commit()
-                logger.info(f"Updated summary for conversation {conversation_id}")
-                return True
-        except Exception as e:
-            logger.error(f"Failed to update conversation summary: {e}")
-            raise
+    def get_all_conversations(self, batch_size: int = 500) -> Iterator[Dict]:
+        """Iterate over all conversations (for testing/debugging) without loading them all at once"""
+        # Page through by (updated_at, id) and return the reader to the pool
+        # between pages, so a caller that stops early never holds a connection
+        query = """
+            SELECT id, session_id, bot_name, persona, model, created_at, updated_at,
+                   IFNULL(updated_at, '') AS sort_key
+            FROM conversations 
+            WHERE (IFNULL(updated_at, ''), id) < (?, ?)
+            ORDER BY sort_key DESC, id DESC
+            LIMIT ?
+        """
+        # '~' sorts after every timestamp and UUID, so the first page starts at the top
+        last = ("~", "~")
+        while True:
+            try:
+                with self._reader() as conn:
+                    rows = conn.execute(query, (*last, batch_size)).fetchall()
+            except Exception as e:
+                logger.error(f"Failed to get all conversations: {e}")
+                raise
+            
+            for row in rows:
+                conversation = dict(row)
+                last = (conversation.pop('sort_key'), conversation['id'])
+                yield conversation
+            if len(rows) < batch_size:
+                return
     
-    def get_all_conversations(self) -> List[Dict]:
-        """Get all conversations (for testing/debugging)"""
+    def count_conversations(self) -> int:
+        """Count all conversations"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT id, session_id, bot_name, persona, model, created_at, updated_at
-                    FROM conversations 
-                    ORDER BY updated_at DESC
-                """)
-                
-                conversations = []
-                for row in cursor.fetchall():
-                    conversations.append({
-                        'id': row[0],
-                        'session_id': row[1],
-                        'bot_name': row[2],
-                        'persona': row[3],
-                        'model': row[4],
-                        'created_at': row[5],
-                        'updated_at': row[6]
-                    })
-                
-                return conversations
+            with self._reader() as conn:
+                return conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
         except Exception as e:
-            logger.error(f"Failed to get all conversations: {e}")
+            logger.error(f"Failed to count conversations: {e}")
             raise
+
+
+@lru_cache(maxsize=None)
+def get_database_service(db_path: str = "conversations.db") -> DatabaseService:
+    """Return the process-wide DatabaseService for a database file, creating it once"""
+    return DatabaseService(db_path)
@@ -1,5 +1,6 @@
 import faiss
 import numpy as np
+from functools import lru_cache
 from typing import List, Dict, Optional
 from sentence_transformers import SentenceTransformer
 import logging
@@ -27,6 +28,38 @@ class VectorService:
         except Exception as e:
             logger.error(f"Failed to load sentence transformer model: {e}")
             raise
+        
+        # Stored vectors are kept as 8-bit scalars (4x smaller than float32).
+        # The model emits unit-length embeddings, so every component lies in
+        # [-1, 1]; training on those bounds fixes the quantizer range once and
+        # each conversation index is cloned from this template.
+        self.index_template = faiss.IndexScalarQuantizer(
+            self.dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        self.index_template.train(np.array([
+            [-1.0] * self.dimension,
+            [1.0] * self.dimension
+        ], dtype='float32'))
+        
+        # Query embeddings are memoized so repeated or retried questions skip
+        # the model forward pass
+        self.embed_query = lru_cache(maxsize=2048)(self._embed_query)
+        
+        # One throwaway encode pays the model's lazy first-call setup at startup
+        # instead of on the first user message
+        self._embed_query("warmup")
+    
+    def _embed_query(self, query: str) -> np.ndarray:
+        """
+        Embed a single query string
+        
+        Args:
+            query: Query text to embed
+        
+        Returns:
+            float32 embedding vector (treat as read-only, it is shared via the cache)
+        """
+        return self.model.encode([query], convert_to_tensor=False).astype('float32')[0]
     
     def add_messages(self, conversation_id: str, messages: List[Dict]) -> bool:
         """
@@ -43,7 +76,7 @@ class VectorService:
             # Get or create conversation index
             if conversation_id not in self.conversation_indexes:
                 self.conversation_indexes[conversation_id] = {
-                    'index': faiss.IndexFlatIP(self.dimension),
+                    'index': faiss.clone_index(self.index_template),
                     'metadata': []
                 }
             
@@ -78,14 +111,15 @@ class VectorService:
             # Add metadata
             conversation_data['metadata'].extend(message_metadata)
             
-            logger.info(f"Added {len(texts)} embeddings for conversation {conversation_id}")
+            logger.debug(f"Added {len(texts)} embeddings for conversation {conversation_id}")
             return True
             
         except Exception as e:
             logger.error(f"Error adding messages: {e}")
             return False
     
-    def search_similar_messages(self, conversation_id: str, query: str, k: int = 5, min_score: float = 0.2) -> List[Dict]:
+    def search_similar_messages(self, conversation_id: str, query: str, k: int = 5, min_score: float = 0.2,
+                                query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """
         Search for similar messages in a specific conversation
         
@@ -94,6 +128,7 @@ class VectorService:
             query: Search query text
             k: Number of results to return
             min_score: Minimum similarity score threshold
+            query_embedding: Precomputed embedding of the query; skips re-embedding when given
         
         Returns:
             List of similar message dictionaries
@@ -111,11 +146,12 @@ class VectorService:
                 logger.warning(f"Empty index for conversation {conversation_id}")
                 return []
             
-            # Generate query embedding
-            query_embedding = self.model.encode([query], convert_to_tensor=False)
+            # Generate query embedding unless the caller already has one
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
             
             # Search
-            scores, indices = index.search(query_embedding.astype('float32'), min(k, index.ntotal))
+            scores, indices = index.search(query_embedding.reshape(1, -1), min(k, index.ntotal))
             
             # Filter results by minimum score and format
             results = []
@@ -125,7 +161,7 @@ class VectorService:
                     result['similarity_score'] = float(score)
                     results.append(result)
             
-            logger.info(f"Found {len(results)} similar messages for query in conversation {conversation_id}")
+            logger.debug(f"Found {len(results)} similar messages for query in conversation {conversation_id}")
             return results
             
         except Exception as e:
@@ -180,7 +216,7 @@ class VectorService:
                 "total_messages": len(metadata),
                 "user_messages": user_messages,
                 "assistant_messages": assistant_messages,
-                "index_type": "faiss.IndexFlatIP"
+                "index_type": "faiss.IndexScalarQuantizer(QT_8bit)"
             }
         except Exception as e:
             logger.error(f"Error getting conversation stats: {e}")
@@ -208,3 +244,8 @@ class VectorService:
         except Exception as e:
             logger.error(f"Error getting all stats: {e}")
             return {"error": str(e)}
+
+@lru_cache(maxsize=None)
+def get_vector_service(model_name: str = "all-MiniLM-L6-v2") -> VectorService:
+    """Return the process-wide VectorService for an embedding model, loading it once"""
+    return VectorService(model_name)